@@ -3,54 +3,110 @@ import cabaret
 import numpy as np
 import matplotlib.pyplot as plt
 import os
+import fitsio
+import subprocess
 
 from matplotlib.animation import FuncAnimation
 from astropy.io import fits
 from prose import Telescope, FITSImage, FitsManager, Sequence, blocks
 from datetime import datetime, timedelta
 
-from prose import utils
+from astropy.visualization import ZScaleInterval
 
 fm = FitsManager("./images_generated_all_guiding", depth=1)
-ref =FITSImage(fm.all_images[0]) 
+ref = fitsio.read(fm.all_images[0])
 
 
 # Assume you have a list of 100 NumPy arrays (1024x1024)
 # Replace this with your actual data
 num_frames = len(fm.all_images)
 
-images = []
-for i in range(len(fm.all_images)):
-    images.append(FITSImage(fm.all_images[i]).data)
+# Load the frames straight into a single (N, H, W) array so that the normalization runs in one pass,
+# integer CCD data is kept as uint16 so that the 8-bit conversion can use a lookup table
+frames_dtype = np.uint16 if np.issubdtype(ref.dtype, np.uint16) else np.float32
+frames = np.empty((num_frames, *ref.shape), dtype=frames_dtype)
+
+# Frames are decoded in strips of rows straight into the stack, so no full size temporary is allocated per file
+rows_per_strip = 128
+
+def load_frame(i):
+    with fitsio.FITS(fm.all_images[i]) as fits_file:
+        hdu = fits_file[0]
+        for row in range(0, ref.shape[0], rows_per_strip):
+            frames[i, row:row + rows_per_strip] = hdu[row:row + rows_per_strip, :]
+
+for i in range(num_frames):
+    load_frame(i)
     
-import numpy as np
-from PIL import Image
+import imageio.v3 as imageio
 
-# Example list of 100 NumPy arrays (replace this with your actual data)
+def to_8bit(values, values_min, scale, out):
+    # Linear stretch of float32 values to 0-255 done in place, then rounded and cast into out
+    np.subtract(values, values_min, out=values)
+    np.multiply(values, scale, out=values)
+    np.clip(values, 0, 255, out=values) # z-scale limits are not the frame extrema
+    np.rint(values, out=values)
+    np.copyto(out, values, casting='unsafe')
 
+# Normalize frames to 8-bit range (0-255), either with a z-scale stretch or a plain min/max stretch
+scaling = "zscale" # "zscale" or "minmax"
 
-# Normalize frames to 8-bit range (0-255)
-#frames_normalized = [(frame - frame.min()) / (frame.max() - frame.min()) * 255 for frame in frames]
-#frames_normalized = [frame.astype(np.uint8) for frame in frames_normalized]
+if scaling == "zscale":
+    interval = ZScaleInterval(contrast=0.1)
+    limits = np.array([interval.get_limits(frame) for frame in frames], dtype=np.float32)
+    frames_min = limits[:, 0, None, None]
+    frames_max = limits[:, 1, None, None]
+else:
+    frames_min = frames.min(axis=(1, 2), keepdims=True).astype(np.float32)
+    frames_max = frames.max(axis=(1, 2), keepdims=True).astype(np.float32)
 
-# Convert NumPy arrays to PIL Image objects
+scale = np.float32(255.0) / (frames_max - frames_min)
 
+# Preallocated 8-bit stack
+frames_8bit = np.empty(frames.shape, dtype=np.uint8)
 
-for i in range(len(images)):
-    images[i] = utils.z_scale(images[i], 0.1)#, cmap=Greys_r), origin="lower", **kwargs
-    #images[i] = plt.get_cmap("Greys_r")(images[i]) 
-#print(images[0].shape, images[0])
+if frames.dtype == np.uint16:
+    # Build a 65536 entry table per frame and gather from it, instead of float arithmetic on every pixel
+    levels = np.arange(65536, dtype=np.float32)
+    lut_values = np.empty_like(levels)
+    lut = np.empty(levels.shape, dtype=np.uint8)
+    for i in range(num_frames):
+        np.copyto(lut_values, levels)
+        to_8bit(lut_values, frames_min[i, 0, 0], scale[i, 0, 0], lut)
+        # uint16 indices are always in range, so 'clip' only avoids buffering out. np.take still converts the
+        # uint16 frame to a full size intp index array, the saving is the per-pixel float math, not the temporaries
+        np.take(lut, frames[i], out=frames_8bit[i], mode='clip')
+else:
+    to_8bit(frames, frames_min, scale, frames_8bit)
 
-images = [Image.fromarray(frame, mode='RGBA') for frame in images]
+# GIF encoding runs in-process, so long sequences are piped to ffmpeg and encoded to MP4 on another core instead
+max_gif_frames = 100
 
-# Save as an animated GIF
-output_file = "output.gif"
-images[0].save(
-    output_file,
-    save_all=True,
-    append_images=images[1:],  # Add the rest of the frames
-    duration=100,  # Duration for each frame in milliseconds (adjust as needed)
-    loop=0,  # Infinite loop   
-)
+if num_frames <= max_gif_frames:
+    # Save as an animated GIF. Pillow encodes all the frames in one save call, so this is no faster and holds no
+    # less in memory than PIL's append_images, it only takes the uint8 stack without converting it to PIL images
+    output_file = "output.gif"
+    imageio.imwrite(output_file, frames_8bit, plugin='pillow', is_batch=True, duration=100, loop=0) # duration in milliseconds, loop=0 for infinite loop
+else:
+    # Stream the raw 8-bit frames to ffmpeg through its stdin, at the same 10 frames per second as the GIF.
+    # The frame stacks are already resident, this moves the encoding off this process rather than reducing memory
+    output_file = "output.mp4"
+    height, width = frames_8bit.shape[1:]
+    ffmpeg = subprocess.Popen([
+        'ffmpeg', '-y', '-loglevel', 'error',
+        '-f', 'rawvideo', '-pix_fmt', 'gray', '-s', f'{width}x{height}', '-r', '10', '-i', '-',
+        '-c:v', 'libx264', '-pix_fmt', 'yuv420p', output_file
+    ], stdin=subprocess.PIPE)
+    try:
+        for frame in frames_8bit:
+            ffmpeg.stdin.write(frame) # contiguous uint8 frame, written without an intermediate bytes copy
+    finally:
+        # Always reap ffmpeg, also when it exits mid-stream and the writes fail with a broken pipe
+        try:
+            ffmpeg.stdin.close()
+        except BrokenPipeError:
+            pass # ffmpeg already exited, its exit status is checked below
+        if ffmpeg.wait() != 0:
+            raise subprocess.CalledProcessError(ffmpeg.returncode, ffmpeg.args)
 
-print(f"GIF saved as {output_file}")
+print(f"Animation saved as {output_file}")
@@ -2,8 +2,10 @@
 
 import os
 import numpy as np
-from prose import FitsManager, FITSImage, Telescope
-from astropy.io import fits
+from prose import FitsManager, Telescope
+import fitsio
+from scipy.stats import truncnorm
+from numba import njit, prange
 
 def bad_pixel_locations(
         image, 
@@ -32,7 +34,7 @@ def bad_pixel_locations(
         dead_upper_limit (float): Maximum value for the dead pixels.
 
     Returns:
-        np.ndarray: Indices and values of the hot and cold pixels.
+        np.ndarray: Flat indices and values of the hot and cold pixels.
     """
 
     # Copy the image to avoid modifying the original
@@ -43,33 +45,55 @@ def bad_pixel_locations(
     num_hot_pixels = int(total_pixels * (hot_percentage / 100))
     num_dead_pixels = int(total_pixels * (dead_percentage / 100))
 
-    # Randomly select unique indices for hot and dead pixels
-    hot_indices = np.random.choice(total_pixels, num_hot_pixels, replace=False)
-    remaining_indices = np.setdiff1d(np.arange(total_pixels), hot_indices)
-    dead_indices = np.random.choice(remaining_indices, num_dead_pixels, replace=False)
-
-    # Convert indices to the original shape
-    hot_indices = np.unravel_index(hot_indices, modified_image.shape)
-    dead_indices = np.unravel_index(dead_indices, modified_image.shape)
-
-    # Generate hot pixel values from a Gaussian distribution, clipped to the specified range
-    hot_pixel_values = []
-    while len(hot_pixel_values) < num_hot_pixels:
-        sample = np.random.normal(loc=hot_peak, scale=np.sqrt(hot_std_dev))
-        if sample <= hot_upper_limit:
-            hot_pixel_values.append(sample)
-    hot_pixel_values = np.array(hot_pixel_values)
-
-    # Generate dead pixel values from a Gaussian distribution within the [dead_lower_limit, dead_upper_limit]
-    dead_pixel_values = []
-    while len(dead_pixel_values) < num_dead_pixels:
-        sample = np.random.normal(loc=dead_mean, scale=dead_std_dev)
-        if dead_lower_limit <= sample:
-            dead_pixel_values.append(sample)
-    dead_pixel_values = np.array(dead_pixel_values)
+    # Randomly select unique flat indices for hot and dead pixels in a single draw so that they never overlap
+    bad_indices = np.random.choice(total_pixels, num_hot_pixels + num_dead_pixels, replace=False)
+    hot_indices = bad_indices[:num_hot_pixels]
+    dead_indices = bad_indices[num_hot_pixels:]
+
+    # Generate hot pixel values from a Gaussian distribution truncated above at hot_upper_limit
+    hot_scale = np.sqrt(hot_std_dev)
+    hot_pixel_values = truncnorm.rvs(
+        -np.inf, (hot_upper_limit - hot_peak) / hot_scale,
+        loc=hot_peak, scale=hot_scale, size=num_hot_pixels)
+
+    # Generate dead pixel values from a Gaussian distribution truncated below at dead_lower_limit
+    dead_pixel_values = truncnorm.rvs(
+        (dead_lower_limit - dead_mean) / dead_std_dev, np.inf,
+        loc=dead_mean, scale=dead_std_dev, size=num_dead_pixels)
     
     return hot_indices, dead_indices, hot_pixel_values, dead_pixel_values
 
+def write_image(filename, image, image_type, date):
+    """
+    Save an image with its image type and observation date in the header, overwriting any existing file.
+
+    Parameters:
+        filename (str): Path of the FITS file to write.
+        image (np.ndarray): Image data.
+        image_type (str): Value of the image type keyword (light or dark).
+        date (str): Observation date of the image, as found in the raw image header.
+    """
+    fitsio.write(filename, image, clobber=True, header={
+        Telescope.keyword_image_type: image_type,
+        Telescope.keyword_observation_date: date
+    })
+
+def image_shape(fm):
+    """
+    Shape of the images of a FitsManager, read from the header of its first light or dark image without decoding the data.
+
+    Parameters:
+        fm (FitsManager): FitsManager of the raw images.
+
+    Returns:
+        tuple: (height, width) of the images, (0, 0) if there are none.
+    """
+    paths = [*fm.all_images, *fm.all_darks]
+    if len(paths) == 0:
+        return (0, 0)
+    header = fitsio.read_header(paths[0])
+    return (header['NAXIS2'], header['NAXIS1'])
+
 def add_bad_pixels(dir_raw_images, dir_bad_images, hot_indices, dead_indices, hot_pixel_values, dead_pixel_values):
     """
     Introduce hot and dead pixels into an image while ensuring no overlap in indices and setting value limits for both types of pixels.
@@ -77,8 +101,8 @@ def add_bad_pixels(dir_raw_images, dir_bad_images, hot_indices, dead_indices, ho
     Parameters:
         dir_raw_images (str): Directory containing the raw images.
         dir_bad_images (str): Directory to save the images with bad pixels.
-        hot_indices (tuple): Indices of the hot pixels.
-        dead_indices (tuple): Indices of the dead pixels.
+        hot_indices (np.ndarray): Flat indices of the hot pixels.
+        dead_indices (np.ndarray): Flat indices of the dead pixels.
         hot_pixel_values (np.ndarray): Values for the hot pixels.
         dead_pixel_values (np.ndarray): Values for the dead pixels.
 
@@ -91,40 +115,52 @@ def add_bad_pixels(dir_raw_images, dir_bad_images, hot_indices, dead_indices, ho
     dir_bad_images = "./images_all_guiding_hot_cold_warm_pixels"
     os.makedirs(dir_bad_images, exist_ok=True)
 
+    # Working buffer reused for every light and dark image, float64 like FITSImage.data so the bad pixel values are kept as drawn
+    raw_image = np.empty(image_shape(fm), dtype=np.float64)
+
     for i in range(len(fm.all_images)):
-        raw_image = FITSImage(fm.all_images[i]).data  # 1024x1024 image filled with ones
+        data, header = fitsio.read(fm.all_images[i], header=True)
+        np.copyto(raw_image, data)  # 1024x1024 image filled with ones
 
         # Set hot pixel values
-        raw_image[hot_indices] = hot_pixel_values
+        np.put(raw_image, hot_indices, hot_pixel_values)
         # Set dead pixel values
-        raw_image[dead_indices] = dead_pixel_values   
+        np.put(raw_image, dead_indices, dead_pixel_values)   
 
         raw_output_filename = os.path.join(dir_bad_images, f"image_light_hcw_pixels_{i+1}.fits")
 
         # Save the raw image in "images_generated" directory
-        fits.writeto(raw_output_filename, raw_image, overwrite=True, header=fits.Header([
-            (Telescope.keyword_image_type, Telescope.keyword_light_images),
-            (Telescope.keyword_observation_date, FITSImage(fm.all_images[i]).date.strftime('%Y-%m-%dT%H:%M:%S.%f'))
-        ]))
+        write_image(raw_output_filename, raw_image, Telescope.keyword_light_images, header[Telescope.keyword_observation_date])
     
     for i in range(len(fm.all_darks)):
-        raw_image = FITSImage(fm.all_darks[i]).data  # 1024x1024 image filled with ones
+        data, header = fitsio.read(fm.all_darks[i], header=True)
+        np.copyto(raw_image, data)  # 1024x1024 image filled with ones
 
         # Set hot pixel values
-        raw_image[hot_indices] = hot_pixel_values
+        np.put(raw_image, hot_indices, hot_pixel_values)
         # Set dead pixel values
-        raw_image[dead_indices] = dead_pixel_values   
+        np.put(raw_image, dead_indices, dead_pixel_values)   
 
         raw_output_filename = os.path.join(dir_bad_images, f"image_dark_hcw_pixels_{i+1}.fits")
 
         # Save the raw image in "images_generated" directory
-        fits.writeto(raw_output_filename, raw_image, overwrite=True, header=fits.Header([
-            (Telescope.keyword_image_type, Telescope.keyword_dark_images),
-            (Telescope.keyword_observation_date, FITSImage(fm.all_darks[i]).date.strftime('%Y-%m-%dT%H:%M:%S.%f'))
-        ]))
+        write_image(raw_output_filename, raw_image, Telescope.keyword_dark_images, header[Telescope.keyword_observation_date])
 
     print(f"Light and dark images with bad pixels have been modified and saved in {dir_bad_images}")
 
+@njit(parallel=True, boundscheck=False)
+def scatter_pixels(flat_image, indices, values):
+    """
+    Set the pixels of a flattened image at the given indices, in a single compiled pass.
+
+    Parameters:
+        flat_image (np.ndarray): 1D view of the image to modify in place.
+        indices (np.ndarray): Unique flat indices of the pixels to set.
+        values (np.ndarray): Values for the pixels, one per index.
+    """
+    for k in prange(indices.shape[0]):
+        flat_image[indices[k]] = values[k]
+
 def add_telegraphic_pixels(dir_raw_images, dir_bad_images, telegraphic_percentage, interval, telegraphic_pixel_values=0):
     """
     Introduce telegraphic pixels into an image while ensuring no overlap in indices and setting value limits for telegraphic pixels.
@@ -132,59 +168,54 @@ def add_telegraphic_pixels(dir_raw_images, dir_bad_images, telegraphic_percentag
     Parameters:
         dir_raw_images (str): Directory containing the raw images.
         dir_bad_images (str): Directory to save the images with telegraphic pixels.
-        telegraphic_indices (tuple): Indices of the telegraphic pixels.
-        telegraphic_pixel_values (np.ndarray): Values for the telegraphic pixels.
+        telegraphic_indices (np.ndarray): Flat indices of the telegraphic pixels.
+        telegraphic_pixel_values (float or np.ndarray): Value(s) for the telegraphic pixels.
 
     Returns:
         np.ndarray: Saves the images with telegraphic pixels in the specified directory.
     """
 
     fm = FitsManager(dir_raw_images, depth=1)
-    modified_image = FITSImage(fm.all_images[0]).data  # 1024x1024 image filled with ones
     
     dir_bad_images = "./images_all_guiding_bad_pixels"
     os.makedirs(dir_bad_images, exist_ok=True)
 
-    total_pixels = modified_image.size
+    # Working buffer reused for every light and dark image, float64 like FITSImage.data
+    raw_image = np.empty(image_shape(fm), dtype=np.float64)  # 1024x1024 image
+
+    total_pixels = raw_image.size
     num_telegraphic_pixels = int(total_pixels * (telegraphic_percentage / 100))
     telegraphic_indices = np.random.choice(total_pixels, num_telegraphic_pixels, replace=False)
-    telegraphic_indices = np.unravel_index(telegraphic_indices, modified_image.shape)
+
+    telegraphic_values = np.broadcast_to(np.asarray(telegraphic_pixel_values, dtype=raw_image.dtype), telegraphic_indices.shape)
 
     for i in range(len(fm.all_images)):
     
-        raw_image = FITSImage(fm.all_images[i]).data  # 1024x1024 image filled with ones
+        data, header = fitsio.read(fm.all_images[i], header=True)
+        np.copyto(raw_image, data)  # 1024x1024 image filled with ones
         
         if i%interval == 0 and i != 0:
-            # Set hot pixel values
-            raw_image[telegraphic_indices] = telegraphic_pixel_values
-            # Set dead pixel values
-            raw_image[telegraphic_indices] = telegraphic_pixel_values   
+            # Set telegraphic pixel values
+            scatter_pixels(raw_image.ravel(), telegraphic_indices, telegraphic_values)
 
         raw_output_filename = os.path.join(dir_bad_images, f"image_light_guiding_bad_pixels_{i+1}.fits")
 
         # Save the raw image in "images_generated" directory
-        fits.writeto(raw_output_filename, raw_image, overwrite=True, header=fits.Header([
-            (Telescope.keyword_image_type, Telescope.keyword_light_images),
-            (Telescope.keyword_observation_date, FITSImage(fm.all_images[i]).date.strftime('%Y-%m-%dT%H:%M:%S.%f'))
-        ]))
+        write_image(raw_output_filename, raw_image, Telescope.keyword_light_images, header[Telescope.keyword_observation_date])
 
     for i in range(len(fm.all_darks)):
     
-        raw_image = FITSImage(fm.all_darks[i]).data  # 1024x1024 image filled with ones
+        data, header = fitsio.read(fm.all_darks[i], header=True)
+        np.copyto(raw_image, data)  # 1024x1024 image filled with ones
 
         if i%interval == 0 and i != 0:
-            # Set hot pixel values
-            raw_image[telegraphic_indices] = telegraphic_pixel_values
-            # Set dead pixel values
-            raw_image[telegraphic_indices] = telegraphic_pixel_values
+            # Set telegraphic pixel values
+            scatter_pixels(raw_image.ravel(), telegraphic_indices, telegraphic_values)
 
         raw_output_filename = os.path.join(dir_bad_images, f"image_dark_guiding_bad_pixels_{i+1}.fits")
 
         # Save the raw image in "images_generated" directory
-        fits.writeto(raw_output_filename, raw_image, overwrite=True, header=fits.Header([
-            (Telescope.keyword_image_type, Telescope.keyword_dark_images),
-            (Telescope.keyword_observation_date, FITSImage(fm.all_darks[i]).date.strftime('%Y-%m-%dT%H:%M:%S.%f'))
-        ]))
+        write_image(raw_output_filename, raw_image, Telescope.keyword_dark_images, header[Telescope.keyword_observation_date])
 
 
 
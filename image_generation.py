@@ -1,36 +1,95 @@
 import cabaret
 import numpy as np
 import os
-import random
+import math
+import errno
 from astropy.io import fits
 from prose import Telescope
 from datetime import datetime, timedelta
 import shutil
-from scipy.stats import skewnorm
+from functools import lru_cache
+
+
+# Random number generator used by default for all the draws of this module,
+# seed it with image_generation.random_generator = np.random.default_rng(seed) for reproducible images
+random_generator = np.random.default_rng()
 
 
 # Generate a skewed distribution
-def warm_pixels(camera, exposure_time = 10, mean_warm = 45.6+5, std_warm = 9.3, skewness_warm = 6, size=10000):
-    base = np.ones((camera.height, camera.width))
-    base += np.random.poisson(base * camera.dark_current * exposure_time)
+def warm_pixels(camera, exposure_time = 10, mean_warm = 45.6+5, std_warm = 9.3, skewness_warm = 6, size=10000, rng=None):
+    if rng is None:
+        rng = random_generator
 
-    # Generate data from a skewed normal distribution
-    data = skewnorm.rvs(a=skewness_warm, size=size)
-    
-    # Scale to match the target standard deviation
-    data_std = np.std(data)
-    scaled_data = data / data_std * std_warm  # Normalize to std=1 and scale to target std
+    # Dark current on top of a base level of one, kept in float32 to halve the memory traffic
+    warm = rng.poisson(camera.dark_current * exposure_time, size=(camera.height, camera.width)).astype(np.float32)
+    warm += 1
+
+    # Generate data from a skewed normal distribution, X = delta*|U| + sqrt(1 - delta^2)*V with U, V standard normal
+    delta = skewness_warm / math.sqrt(1 + skewness_warm**2)
+    scaled_data = np.abs(rng.standard_normal(size, dtype=np.float32))
+    scaled_data *= delta
+    noise = rng.standard_normal(size, dtype=np.float32)
+    noise *= math.sqrt(1 - delta**2) # python float, so the product stays float32
+    scaled_data += noise
     
-    # Adjust to match the target mean after skewing
-    scaled_data = scaled_data + (mean_warm - np.mean(scaled_data))
+    # Scale to match the target standard deviation and shift to match the target mean, in place
+    data_mean, data_std = scaled_data.mean(), scaled_data.std()
+    scaled_data -= data_mean
+    scaled_data *= std_warm / data_std
+    scaled_data += mean_warm
     scaled_data = scaled_data.reshape(camera.height, camera.width)
-    warm = base + scaled_data
+
+    warm += scaled_data
     warm = warm.astype(np.uint16)
 
     return warm, scaled_data
 
 
-def generate_light_images(ra, dec, exposure_time, base_date, num_pixels_shift, num_light_images, seeing_data, camera, telescope, dir_base_images_light = 'images_light_guiding_warm_pixels'):
+# Warm pixels model a fixed sensor defect, so a single pattern is shared by all the images of a camera
+warm_pixels_cache = {}
+
+def cached_warm_pixels(camera, exposure_time, warm_cache_file=None):
+    """
+    Return the warm pixel image of a camera, generating it at most once per camera and exposure time.
+
+    Parameters
+    ----------
+    camera : cabaret.Camera
+        Camera the warm pixels belong to.
+    exposure_time : float
+        Exposure time of the images in seconds.
+    warm_cache_file : str, optional
+        Path of a .npz file used to persist the warm pixel image across runs, regenerated if it was made for another camera or exposure time.
+    """
+    key = (camera.width, camera.height, camera.dark_current, exposure_time)
+
+    if key not in warm_pixels_cache:
+        warm = None
+
+        # Only reuse a persisted pattern generated for the same camera and exposure time
+        if warm_cache_file is not None and os.path.exists(warm_cache_file):
+            with np.load(warm_cache_file) as cached:
+                if np.array_equal(cached['key'], np.array(key, dtype=np.float64)):
+                    warm = cached['warm']
+
+        if warm is None:
+            warm, scaled_data = warm_pixels(camera, exposure_time, size=camera.width*camera.height)
+            if warm_cache_file is not None:
+                # Written through a file object so that np.savez does not append .npz to the given path
+                with open(warm_cache_file, 'wb') as f:
+                    np.savez(f, warm=warm, key=np.array(key, dtype=np.float64))
+        warm_pixels_cache[key] = warm
+
+    return warm_pixels_cache[key]
+
+
+# Sites only depend on the seeing, so images sharing a seeing value share a site
+@lru_cache(maxsize=64)
+def cached_site(seeing):
+    return cabaret.Site(seeing=seeing)
+
+
+def generate_light_images(ra, dec, exposure_time, base_date, num_pixels_shift, num_light_images, seeing_data, camera, telescope, dir_base_images_light = 'images_light_guiding_warm_pixels', warm_cache_file=None, rng=None):
     """
     Generate an image of the sky at a given RA and Dec.
 
@@ -46,6 +105,10 @@ def generate_light_images(ra, dec, exposure_time, base_date, num_pixels_shift, n
         Date and time of the observation.
     num_pixels_shift : int
         Number of pixels to include in the image.
+    warm_cache_file : str, optional
+        Path of a .npz file used to persist the warm pixel image across runs.
+    rng : np.random.Generator, optional
+        Generator for the pointing offsets, defaults to the module level random_generator.
     """
 
     camera.plate_scale = (np.arctan((camera.pitch * 1e-6) / (telescope.focal_length)) * (180 / np.pi) * 3600)  # "/pixel
@@ -56,19 +119,21 @@ def generate_light_images(ra, dec, exposure_time, base_date, num_pixels_shift, n
     dec_min, dec_max = dec - num_pixels_shift*degree_per_pixel, dec + num_pixels_shift*degree_per_pixel
 
     # Generate random RA and Dec values
-    random_ras = [random.uniform(ra_min, ra_max) for _ in range(num_light_images)]
-    random_decs = [random.uniform(dec_min, dec_max) for _ in range(num_light_images)]
+    if rng is None:
+        rng = random_generator
+    random_ras = rng.uniform(ra_min, ra_max, size=num_light_images)
+    random_decs = rng.uniform(dec_min, dec_max, size=num_light_images)
 
     # Directory to save light images
     os.makedirs(dir_base_images_light, exist_ok=True) # Create directory if it doesn't exist
 
     # Create an image with warm pixels
-    warm, scaled_data = warm_pixels(camera, exposure_time, size=camera.width*camera.height)
+    warm = cached_warm_pixels(camera, exposure_time, warm_cache_file)
     
     # Generate light images
     for i in range(num_light_images):
         curr_date = base_date + timedelta(seconds=i*exposure_time) #interval between each image = exposure time
-        site = cabaret.Site(seeing=seeing_data[i])
+        site = cached_site(float(seeing_data[i]))
 
         light = cabaret.generate_image(random_ras[i], random_decs[i], exposure_time, dateobs=curr_date, camera=camera, site=site)
         
@@ -84,7 +149,7 @@ def generate_light_images(ra, dec, exposure_time, base_date, num_pixels_shift, n
             (Telescope.keyword_observation_date, curr_date.strftime('%Y-%m-%dT%H:%M:%S.%f'))
         ]))
 
-def generate_dark_images(ra, dec, exposure_time, base_date, num_dark_images, num_light_images, seeing_data, camera, dir_base_images_dark = 'images_dark_guiding_warm_pixels'):
+def generate_dark_images(ra, dec, exposure_time, base_date, num_dark_images, num_light_images, seeing_data, camera, dir_base_images_dark = 'images_dark_guiding_warm_pixels', warm=None, warm_cache_file=None):
     """
     Generate an image of the sky at a given RA and Dec.
 
@@ -100,10 +165,15 @@ def generate_dark_images(ra, dec, exposure_time, base_date, num_dark_images, num
         Date and time of the observation.
     num_pixels_shift : int
         Number of pixels to include in the image.
+    warm : np.ndarray, optional
+        Precomputed warm pixel image, defaults to the one shared with the light images.
+    warm_cache_file : str, optional
+        Path of a .npz file used to persist the warm pixel image across runs.
     """
     
-    # Create an image with warm pixels
-    warm, scaled_data = warm_pixels(camera, exposure_time, size=camera.width*camera.height)
+    # Create an image with warm pixels, the same pattern as the light images unless one is given
+    if warm is None:
+        warm = cached_warm_pixels(camera, exposure_time, warm_cache_file)
 
     # Directory to save dark images
     os.makedirs(dir_base_images_dark, exist_ok=True) # Create directory if it doesn't exist
@@ -112,7 +182,7 @@ def generate_dark_images(ra, dec, exposure_time, base_date, num_dark_images, num
     # Generate dark images
     for i in range(num_dark_images):
         curr_date = base_date + timedelta(seconds=i*exposure_time) #interval between each image = exposure time
-        site = cabaret.Site(seeing=seeing_data[i+num_light_images])
+        site = cached_site(float(seeing_data[i+num_light_images]))
         
         dark = cabaret.generate_image(ra, dec, exposure_time, dateobs=curr_date, light=0, camera=camera, site=site)
 
@@ -129,18 +199,52 @@ def generate_dark_images(ra, dec, exposure_time, base_date, num_dark_images, num
         ]))
 
 
+def link_or_copy(src, dst_dir):
+    """
+    Hard link a file into a directory, falling back to a copy when linking is not possible (e.g. across file systems).
+
+    Parameters:
+    src (str): The path of the file to link.
+    dst_dir (str): The directory where the file is linked.
+    """
+    dst = os.path.join(dst_dir, os.path.basename(src))
+    # Nothing to do if dst already is src, either the same path or a link made by a previous run
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        return
+    # os.link does not overwrite, so link under a temporary name and move it over dst once the link exists
+    tmp = dst + '.link_tmp'
+    # Remove a temporary link left by an interrupted run, os.link would fail on it
+    if os.path.lexists(tmp):
+        os.unlink(tmp)
+    try:
+        os.link(src, tmp)
+    except OSError as e:
+        # Copy only when hard links are not possible, across file systems or on file systems without them
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EOPNOTSUPP):
+            raise
+        shutil.copy(src, dst)
+        return
+    try:
+        os.replace(tmp, dst)
+    except OSError:
+        os.unlink(tmp)
+        raise
+
+
 def combine_folders(dir_base_images_light, dir_base_images_dark, dir_base_images_all):
 
     # Directory to save all images
     os.makedirs(dir_base_images_all, exist_ok=True)  # Create directory if it doesn't exist
 
-    # Copy contents of 'images_generated_dark' and 'images_generated_light' into 'images_generated_all'
+    # Link contents of 'images_generated_dark' and 'images_generated_light' into 'images_generated_all'
 
-    for filename in os.listdir(dir_base_images_light):
-        shutil.copy(os.path.join(dir_base_images_light, filename), dir_base_images_all)
+    with os.scandir(dir_base_images_light) as entries:
+        for entry in entries:
+            link_or_copy(entry.path, dir_base_images_all)
         
-    for filename in os.listdir(dir_base_images_dark):
-        shutil.copy(os.path.join(dir_base_images_dark, filename), dir_base_images_all)
+    with os.scandir(dir_base_images_dark) as entries:
+        for entry in entries:
+            link_or_copy(entry.path, dir_base_images_all)
 
 
 def delete_files_in_folder(folder_path):
@@ -152,14 +256,14 @@ def delete_files_in_folder(folder_path):
     """
     # Check if the folder exists
     if os.path.exists(folder_path):
-        # Iterate over all the files in the folder
-        for filename in os.listdir(folder_path):
-            file_path = os.path.join(folder_path, filename)
-            try:
-                # Check if it is a file and delete it
-                if os.path.isfile(file_path):
-                    os.unlink(file_path)
-            except Exception as e:
-                print(f'Failed to delete {file_path}. Reason: {e}')
+        # Iterate over all the files in the folder, scandir entries carry their file type without an extra stat call
+        with os.scandir(folder_path) as entries:
+            for entry in entries:
+                try:
+                    # Check if it is a file and delete it
+                    if entry.is_file():
+                        os.unlink(entry.path)
+                except Exception as e:
+                    print(f'Failed to delete {entry.path}. Reason: {e}')
     else:
         print(f'The folder {folder_path} does not exist.')
\ No newline at end of file